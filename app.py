@@ -1,14 +1,15 @@
 import os
 import logging
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context
+from flask_caching import Cache
+from flask_session import Session
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy.exc import IntegrityError
-import openpyxl
-from openpyxl.styles import Font, Alignment, Border, Side
-from openpyxl.utils import get_column_letter
-import io
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import delete, func, insert, select, text
+from sqlalchemy.orm import DeclarativeBase, joinedload
+from sqlalchemy.exc import DBAPIError, IntegrityError
+import tempfile
 
 # Configure logging for debugging
 logging.basicConfig(level=logging.DEBUG)
@@ -21,33 +22,86 @@ db = SQLAlchemy(model_class=Base)
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
 
+# Persist compiled template bytecode so fresh workers skip parsing templates
+app.jinja_options = {**app.jinja_options, "bytecode_cache": FileSystemBytecodeCache()}
+
 # Configure the database
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
+# The pool is per process: keep workers * (pool_size + max_overflow) under the
+# database's max_connections (100 by default on PostgreSQL)
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": int(os.environ.get("DB_POOL_SIZE", 10)),
+    "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 5)),
+    "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 30)),
     "pool_recycle": 300,
     "pool_pre_ping": True,
+    "pool_use_lifo": True,
 }
 
+# Keep session data (bill/reception items) server-side; the cookie only carries the session id
+app.config["SESSION_TYPE"] = "sqlalchemy"
+app.config["SESSION_SQLALCHEMY"] = db
+# Like Flask's own cookie, end the session when the browser closes (Flask-Session defaults to 31 days)
+app.config["SESSION_PERMANENT"] = False
+app.config["SESSION_CLEANUP_N_REQUESTS"] = 100
+# Only write the session back when a request changed it
+app.config["SESSION_REFRESH_EACH_REQUEST"] = False
+
+# Cache for the dashboard; set CACHE_TYPE=RedisCache and CACHE_REDIS_URL to share it between workers
+app.config["CACHE_TYPE"] = os.environ.get("CACHE_TYPE", "SimpleCache")
+app.config["CACHE_REDIS_URL"] = os.environ.get("CACHE_REDIS_URL")
+
 # Initialize the app with the extension
 db.init_app(app)
+Session(app)
+cache = Cache(app)
 
 # Import models after app initialization
 from models import Product, ConsumptionBill, BillItem, ReceptionSheet, ReceptionItem, DraftBill, DraftBillItem, DraftReception, DraftReceptionItem
+from excel import write_xlsx
 
 def init_db():
     """Initialize database tables"""
     with app.app_context():
+        # The product search indexes need the pg_trgm extension
+        create_indexes = True
+        if db.engine.dialect.name == 'postgresql':
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+            except DBAPIError as e:
+                # Usually the role lacks the privilege; search still works, just unindexed
+                logging.warning("Could not create the pg_trgm extension, skipping the product search indexes: %s", e)
+                create_indexes = False
+        
         # Create all tables
         db.create_all()
+        
+        # create_all() only adds indexes along with new tables
+        if create_indexes:
+            for index in Product.__table__.indexes:
+                index.create(db.engine, checkfirst=True)
+
+def has_pending_flashes():
+    """Pages rendering flashed messages must not be served from or stored in the cache"""
+    return '_flashes' in session
 
 @app.route('/')
+@cache.cached(timeout=10, key_prefix='dashboard', unless=has_pending_flashes)
 def index():
     """Dashboard with low stock alerts and recent activity"""
-    # Get low stock products
-    low_stock_products = Product.query.filter(Product.quantity <= Product.min_stock).order_by(Product.quantity.asc()).all()
-    
-    # Get total products count
-    total_products = Product.query.count()
+    # Get total products count and low stock products in one roundtrip: the
+    # one-row count is outer-joined to the low stock rows so it is returned
+    # even when nothing is low on stock
+    total = select(func.count(Product.id).label('total')).subquery()
+    rows = db.session.execute(
+        select(total.c.total, Product)
+        .select_from(total)
+        .outerjoin(Product, Product.quantity <= Product.min_stock)
+        .order_by(Product.quantity.asc())
+    ).all()
+    total_products = rows[0].total
+    low_stock_products = [row.Product for row in rows if row.Product is not None]
     
     # Get recent consumption bills
     recent_bills = ConsumptionBill.query.order_by(ConsumptionBill.bill_date.desc()).limit(5).all()
@@ -99,6 +153,7 @@ def add_product():
             )
             db.session.add(product)
             db.session.commit()
+            cache.delete('dashboard')
             flash('Produsul a fost adăugat cu succes!', 'success')
             return redirect(url_for('products'))
         except IntegrityError:
@@ -127,9 +182,9 @@ def edit_product(product_id):
             product.quantity = quantity
             product.location = location
             product.min_stock = min_stock
-            product.updated_at = datetime.utcnow()
             
             db.session.commit()
+            cache.delete('dashboard')
             flash('Produsul a fost actualizat cu succes!', 'success')
             return redirect(url_for('products'))
         except IntegrityError:
@@ -144,6 +199,7 @@ def delete_product(product_id):
     product = Product.query.get_or_404(product_id)
     db.session.delete(product)
     db.session.commit()
+    cache.delete('dashboard')
     
     flash('Produsul a fost șters cu succes!', 'success')
     return redirect(url_for('products'))
@@ -216,9 +272,9 @@ def save_bill_draft():
     employee_name = request.form.get('employee_name', '')
     employee_signature = request.form.get('employee_signature', '')
     
-    # Clear existing draft
-    DraftBill.query.delete()
-    DraftBillItem.query.delete()
+    # Clear existing draft (items first: tables created before ON DELETE CASCADE still enforce the FK)
+    db.session.execute(delete(DraftBillItem), execution_options={'synchronize_session': False})
+    db.session.execute(delete(DraftBill), execution_options={'synchronize_session': False})
     
     # Save new draft
     draft = DraftBill(
@@ -228,19 +284,9 @@ def save_bill_draft():
     db.session.add(draft)
     db.session.flush()  # Get the ID
     
-    # Save draft items
-    if 'bill_items' in session:
-        for item in session['bill_items']:
-            draft_item = DraftBillItem(
-                draft_id=draft.id,
-                item_number=item['item_number'],
-                product_code=item['code'],
-                product_name=item['name'],
-                unit=item['unit'],
-                quantity=item['quantity'],
-                location=item['location']
-            )
-            db.session.add(draft_item)
+    # Save draft items in a single multi-row INSERT
+    if session.get('bill_items'):
+        db.session.execute(insert(DraftBillItem), item_rows(session['bill_items'], draft_id=draft.id))
     
     db.session.commit()
     
@@ -271,31 +317,28 @@ def finalize_consumption_bill():
         db.session.add(bill)
         db.session.flush()  # Get the ID
         
-        # Add bill items and update stock
+        # Fetch (and lock) every product on the bill in one query
+        codes = {item['code'] for item in session['bill_items']}
+        products = {
+            product.code: product
+            for product in Product.query.filter(Product.code.in_(codes)).with_for_update().all()
+        }
+        
+        # Add bill items in a single multi-row INSERT
+        db.session.execute(insert(BillItem), item_rows(session['bill_items'], bill_id=bill.id))
+        
+        # Update product stock
         for item in session['bill_items']:
-            # Add item to bill
-            bill_item = BillItem(
-                bill_id=bill.id,
-                item_number=item['item_number'],
-                product_code=item['code'],
-                product_name=item['name'],
-                unit=item['unit'],
-                quantity=item['quantity'],
-                location=item['location']
-            )
-            db.session.add(bill_item)
-            
-            # Update product stock
-            product = Product.query.filter_by(code=item['code']).first()
+            product = products.get(item['code'])
             if product:
                 product.quantity -= item['quantity']
-                product.updated_at = datetime.utcnow()
         
-        # Clear draft
-        DraftBill.query.delete()
-        DraftBillItem.query.delete()
+        # Clear draft (items first: tables created before ON DELETE CASCADE still enforce the FK)
+        db.session.execute(delete(DraftBillItem), execution_options={'synchronize_session': False})
+        db.session.execute(delete(DraftBill), execution_options={'synchronize_session': False})
         
         db.session.commit()
+        cache.delete('dashboard')
         
         # Clear session
         session.pop('bill_items', None)
@@ -311,77 +354,33 @@ def finalize_consumption_bill():
 @app.route('/consumption_bills/view/<int:bill_id>')
 def view_consumption_bill(bill_id):
     """View consumption bill details"""
-    bill = ConsumptionBill.query.get_or_404(bill_id)
-    items = BillItem.query.filter_by(bill_id=bill_id).order_by(BillItem.item_number).all()
+    bill = ConsumptionBill.query.options(joinedload(ConsumptionBill.items)).get_or_404(bill_id)
     
-    return render_template('bill_create.html', bill=bill, items=items, view_mode=True)
+    return render_template('bill_create.html', bill=bill, items=bill.items, view_mode=True)
 
 @app.route('/consumption_bills/export/<int:bill_id>')
 def export_consumption_bill(bill_id):
     """Export consumption bill to Excel"""
     bill = ConsumptionBill.query.get_or_404(bill_id)
-    items = BillItem.query.filter_by(bill_id=bill_id).order_by(BillItem.item_number).all()
-    
-    # Create Excel workbook
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = f"Bon Consum {bill_id}"
-    
-    # Header
-    ws['A1'] = 'BON DE CONSUM'
-    ws['A1'].font = Font(bold=True, size=16)
-    ws.merge_cells('A1:G1')
-    ws['A1'].alignment = Alignment(horizontal='center')
-    
-    # Bill info
-    ws['A3'] = f"Data: {bill.bill_date.strftime('%Y-%m-%d %H:%M')}"
-    ws['A4'] = f"Angajat: {bill.employee_name}"
-    ws['A5'] = f"Semnătura: {bill.employee_signature or '-'}"
-    
-    # Table header
-    headers = ['Nr.', 'Cod Produs', 'Denumire', 'U.M.', 'Cantitate', 'Locație']
-    for col, header in enumerate(headers, 1):
-        cell = ws.cell(row=7, column=col, value=header)
-        cell.font = Font(bold=True)
-        cell.border = Border(
-            top=Side(style='thin'),
-            bottom=Side(style='thin'),
-            left=Side(style='thin'),
-            right=Side(style='thin')
-        )
     
-    # Table data
-    for row, item in enumerate(items, 8):
-        ws.cell(row=row, column=1, value=item.item_number)
-        ws.cell(row=row, column=2, value=item.product_code)
-        ws.cell(row=row, column=3, value=item.product_name)
-        ws.cell(row=row, column=4, value=item.unit)
-        ws.cell(row=row, column=5, value=item.quantity)
-        ws.cell(row=row, column=6, value=item.location or '-')
-        
-        # Add borders
-        for col in range(1, 7):
-            ws.cell(row=row, column=col).border = Border(
-                top=Side(style='thin'),
-                bottom=Side(style='thin'),
-                left=Side(style='thin'),
-                right=Side(style='thin')
-            )
-    
-    # Auto-adjust column widths
-    for col in range(1, 7):
-        ws.column_dimensions[get_column_letter(col)].width = 15
-    
-    # Save to memory
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
-    return send_file(
-        output,
-        as_attachment=True,
-        download_name=f'bon_consum_{bill_id}_{datetime.now().strftime("%Y%m%d")}.xlsx',
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    def rows():
+        # Queried while the response streams, fetched from a server-side cursor 1000 rows at a time
+        items = BillItem.query.filter_by(bill_id=bill_id).order_by(BillItem.item_number).yield_per(1000)
+        for item in items:
+            yield (item.item_number, item.product_code, item.product_name,
+                   item.unit, item.quantity, item.location or '-')
+    
+    return excel_response(
+        f'bon_consum_{bill_id}_{datetime.now().strftime("%Y%m%d")}.xlsx',
+        sheet_title=f"Bon Consum {bill_id}",
+        title='BON DE CONSUM',
+        info=[
+            f"Data: {bill.bill_date.strftime('%Y-%m-%d %H:%M')}",
+            f"Angajat: {bill.employee_name}",
+            f"Semnătura: {bill.employee_signature or '-'}"
+        ],
+        headers=['Nr.', 'Cod Produs', 'Denumire', 'U.M.', 'Cantitate', 'Locație'],
+        rows=rows()
     )
 
 @app.route('/reception')
@@ -393,8 +392,7 @@ def reception():
 @app.route('/reception/view/<int:reception_id>')
 def view_reception(reception_id):
     """View reception details"""
-    reception = ReceptionSheet.query.get_or_404(reception_id)
-    items = ReceptionItem.query.filter_by(reception_id=reception_id).order_by(ReceptionItem.item_number).all()
+    reception = ReceptionSheet.query.options(joinedload(ReceptionSheet.items)).get_or_404(reception_id)
     
     # Return JSON for AJAX request
     return jsonify({
@@ -414,77 +412,34 @@ def view_reception(reception_id):
             'quantity': item.quantity,
             'location': item.location,
             'entry_date': item.entry_date.isoformat()
-        } for item in items]
+        } for item in reception.items]
     })
 
 @app.route('/reception/export/<int:reception_id>')
 def export_reception(reception_id):
     """Export reception to Excel"""
     reception = ReceptionSheet.query.get_or_404(reception_id)
-    items = ReceptionItem.query.filter_by(reception_id=reception_id).order_by(ReceptionItem.item_number).all()
-    
-    # Create Excel workbook
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = f"Receptie {reception_id}"
-    
-    # Header
-    ws['A1'] = 'FIȘĂ DE RECEPȚIE'
-    ws['A1'].font = Font(bold=True, size=16)
-    ws.merge_cells('A1:G1')
-    ws['A1'].alignment = Alignment(horizontal='center')
-    
-    # Reception info
-    ws['A3'] = f"Data: {reception.reception_date.strftime('%Y-%m-%d %H:%M')}"
-    ws['A4'] = f"Furnizor: {reception.supplier}"
-    ws['A5'] = f"Nr. Document: {reception.document_number or '-'}"
-    ws['A6'] = f"Observații: {reception.notes or '-'}"
-    
-    # Table header
-    headers = ['Nr.', 'Cod Produs', 'Denumire', 'U.M.', 'Cantitate', 'Locație', 'Data Intrare']
-    for col, header in enumerate(headers, 1):
-        cell = ws.cell(row=8, column=col, value=header)
-        cell.font = Font(bold=True)
-        cell.border = Border(
-            top=Side(style='thin'),
-            bottom=Side(style='thin'),
-            left=Side(style='thin'),
-            right=Side(style='thin')
-        )
     
-    # Table data
-    for row, item in enumerate(items, 9):
-        ws.cell(row=row, column=1, value=item.item_number)
-        ws.cell(row=row, column=2, value=item.product_code)
-        ws.cell(row=row, column=3, value=item.product_name)
-        ws.cell(row=row, column=4, value=item.unit)
-        ws.cell(row=row, column=5, value=item.quantity)
-        ws.cell(row=row, column=6, value=item.location or '-')
-        ws.cell(row=row, column=7, value=item.entry_date.strftime('%Y-%m-%d'))
-        
-        # Add borders
-        for col in range(1, 8):
-            ws.cell(row=row, column=col).border = Border(
-                top=Side(style='thin'),
-                bottom=Side(style='thin'),
-                left=Side(style='thin'),
-                right=Side(style='thin')
-            )
-    
-    # Auto-adjust column widths
-    for col in range(1, 8):
-        ws.column_dimensions[get_column_letter(col)].width = 15
-    
-    # Save to memory
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
-    return send_file(
-        output,
-        as_attachment=True,
-        download_name=f'receptie_{reception_id}_{datetime.now().strftime("%Y%m%d")}.xlsx',
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    def rows():
+        # Queried while the response streams, fetched from a server-side cursor 1000 rows at a time
+        items = ReceptionItem.query.filter_by(reception_id=reception_id).order_by(ReceptionItem.item_number).yield_per(1000)
+        for item in items:
+            yield (item.item_number, item.product_code, item.product_name,
+                   item.unit, item.quantity, item.location or '-',
+                   item.entry_date.date().isoformat())
+    
+    return excel_response(
+        f'receptie_{reception_id}_{datetime.now().strftime("%Y%m%d")}.xlsx',
+        sheet_title=f"Receptie {reception_id}",
+        title='FIȘĂ DE RECEPȚIE',
+        info=[
+            f"Data: {reception.reception_date.strftime('%Y-%m-%d %H:%M')}",
+            f"Furnizor: {reception.supplier}",
+            f"Nr. Document: {reception.document_number or '-'}",
+            f"Observații: {reception.notes or '-'}"
+        ],
+        headers=['Nr.', 'Cod Produs', 'Denumire', 'U.M.', 'Cantitate', 'Locație', 'Data Intrare'],
+        rows=rows()
     )
 
 @app.route('/reception/create')
@@ -547,9 +502,9 @@ def save_reception_draft():
     document_number = request.form.get('document_number', '')
     notes = request.form.get('notes', '')
     
-    # Clear existing draft
-    DraftReception.query.delete()
-    DraftReceptionItem.query.delete()
+    # Clear existing draft (items first: tables created before ON DELETE CASCADE still enforce the FK)
+    db.session.execute(delete(DraftReceptionItem), execution_options={'synchronize_session': False})
+    db.session.execute(delete(DraftReception), execution_options={'synchronize_session': False})
     
     # Save new draft
     draft = DraftReception(
@@ -560,19 +515,9 @@ def save_reception_draft():
     db.session.add(draft)
     db.session.flush()  # Get the ID
     
-    # Save draft items
-    if 'reception_items' in session:
-        for item in session['reception_items']:
-            draft_item = DraftReceptionItem(
-                draft_id=draft.id,
-                item_number=item['item_number'],
-                product_code=item['code'],
-                product_name=item['name'],
-                unit=item['unit'],
-                quantity=item['quantity'],
-                location=item['location']
-            )
-            db.session.add(draft_item)
+    # Save draft items in a single multi-row INSERT
+    if session.get('reception_items'):
+        db.session.execute(insert(DraftReceptionItem), item_rows(session['reception_items'], draft_id=draft.id))
     
     db.session.commit()
     
@@ -605,31 +550,28 @@ def finalize_reception():
         db.session.add(reception)
         db.session.flush()  # Get the ID
         
-        # Add reception items and update stock
+        # Fetch (and lock) every product on the reception in one query
+        codes = {item['code'] for item in session['reception_items']}
+        products = {
+            product.code: product
+            for product in Product.query.filter(Product.code.in_(codes)).with_for_update().all()
+        }
+        
+        # Add reception items in a single multi-row INSERT
+        db.session.execute(insert(ReceptionItem), item_rows(session['reception_items'], reception_id=reception.id))
+        
+        # Update product stock
         for item in session['reception_items']:
-            # Add item to reception
-            reception_item = ReceptionItem(
-                reception_id=reception.id,
-                item_number=item['item_number'],
-                product_code=item['code'],
-                product_name=item['name'],
-                unit=item['unit'],
-                quantity=item['quantity'],
-                location=item['location']
-            )
-            db.session.add(reception_item)
-            
-            # Update product stock
-            product = Product.query.filter_by(code=item['code']).first()
+            product = products.get(item['code'])
             if product:
                 product.quantity += item['quantity']
-                product.updated_at = datetime.utcnow()
         
-        # Clear draft
-        DraftReception.query.delete()
-        DraftReceptionItem.query.delete()
+        # Clear draft (items first: tables created before ON DELETE CASCADE still enforce the FK)
+        db.session.execute(delete(DraftReceptionItem), execution_options={'synchronize_session': False})
+        db.session.execute(delete(DraftReception), execution_options={'synchronize_session': False})
         
         db.session.commit()
+        cache.delete('dashboard')
         
         # Clear session
         session.pop('reception_items', None)
@@ -644,25 +586,25 @@ def finalize_reception():
 
 def load_draft_bill():
     """Load draft bill data"""
-    draft = DraftBill.query.order_by(DraftBill.last_updated.desc()).first()
+    # Draft and its items in one query
+    draft = DraftBill.query.options(joinedload(DraftBill.items)).order_by(DraftBill.last_updated.desc()).first()
     
     if not draft:
         return None
     
-    # Get draft items
-    items = DraftBillItem.query.filter_by(draft_id=draft.id).all()
-    
     # Convert to session format
-    session['bill_items'] = []
-    for item in items:
-        session['bill_items'].append({
-            'item_number': item.item_number,
-            'code': item.product_code,
-            'name': item.product_name,
-            'unit': item.unit,
-            'quantity': item.quantity,
-            'location': item.location
-        })
+    items = [{
+        'item_number': item.item_number,
+        'code': item.product_code,
+        'name': item.product_name,
+        'unit': item.unit,
+        'quantity': item.quantity,
+        'location': item.location
+    } for item in draft.items]
+    
+    # Only touch the session when the items changed, so it isn't saved again on every page load
+    if session.get('bill_items') != items:
+        session['bill_items'] = items
     
     return {
         'employee_name': draft.employee_name,
@@ -671,25 +613,25 @@ def load_draft_bill():
 
 def load_draft_reception():
     """Load draft reception data"""
-    draft = DraftReception.query.order_by(DraftReception.last_updated.desc()).first()
+    # Draft and its items in one query
+    draft = DraftReception.query.options(joinedload(DraftReception.items)).order_by(DraftReception.last_updated.desc()).first()
     
     if not draft:
         return None
     
-    # Get draft items
-    items = DraftReceptionItem.query.filter_by(draft_id=draft.id).all()
-    
     # Convert to session format
-    session['reception_items'] = []
-    for item in items:
-        session['reception_items'].append({
-            'item_number': item.item_number,
-            'code': item.product_code,
-            'name': item.product_name,
-            'unit': item.unit,
-            'quantity': item.quantity,
-            'location': item.location
-        })
+    items = [{
+        'item_number': item.item_number,
+        'code': item.product_code,
+        'name': item.product_name,
+        'unit': item.unit,
+        'quantity': item.quantity,
+        'location': item.location
+    } for item in draft.items]
+    
+    # Only touch the session when the items changed, so it isn't saved again on every page load
+    if session.get('reception_items') != items:
+        session['reception_items'] = items
     
     return {
         'supplier': draft.supplier,
@@ -697,6 +639,33 @@ def load_draft_reception():
         'notes': draft.notes
     }
 
+def item_rows(items, **parent):
+    """Convert session items to row dicts for a bulk INSERT"""
+    return [{
+        **parent,
+        'item_number': item['item_number'],
+        'product_code': item['code'],
+        'product_name': item['name'],
+        'unit': item['unit'],
+        'quantity': item['quantity'],
+        'location': item['location']
+    } for item in items]
+
+def excel_response(filename, **sheet):
+    """Stream a report written by write_xlsx() to the client as an Excel attachment"""
+    def generate():
+        # Spill to disk past 1 MB so large exports don't sit in memory
+        with tempfile.SpooledTemporaryFile(max_size=1 << 20) as output:
+            write_xlsx(output, **sheet)
+            output.seek(0)
+            yield from iter(lambda: output.read(65536), b'')
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
 # Initialize database on startup
 init_db()
 
@@ -0,0 +1,22 @@
+"""Gunicorn settings for production: gevent workers forked from a preloaded app"""
+import os
+
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+worker_class = "gevent"
+# Greenlets per worker; past the database pool they queue for a connection,
+# so keep this bounded rather than gevent's default of 1000
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 100))
+
+# Import the app (and create tables) once in the master before forking
+preload_app = True
+
+def post_worker_init(worker):
+    """Finish setting up a worker once gevent has monkey-patched it"""
+    # psycopg2 talks to the socket in C, so gevent can't patch it; hand its waits to the hub
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+    # Don't share the master's database connections; build a fresh, gevent-aware pool
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
@@ -1,9 +1,42 @@
 from app import db
 from datetime import datetime
+from sqlalchemy import text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+class utcnow(FunctionElement):
+    """Database-side current UTC time, naive like the datetime.utcnow defaults"""
+    type = db.DateTime()
+    inherit_cache = True
+
+@compiles(utcnow, 'postgresql')
+def pg_utcnow(element, compiler, **kw):
+    # now() is converted using the session time zone; pin it to UTC
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+@compiles(utcnow)
+def default_utcnow(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+def has_pg_trgm(ddl, target, bind, **kw):
+    """Only emit the trigram indexes where the pg_trgm extension is installed"""
+    if bind is None:
+        return True
+    return bind.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
 
 class Product(db.Model):
     __tablename__ = 'products'
     
+    # Trigram indexes let PostgreSQL serve the '%search%' ILIKE filters on the products page
+    __table_args__ = (
+        db.Index('ix_products_code_trgm', 'code', postgresql_using='gin',
+                 postgresql_ops={'code': 'gin_trgm_ops'}).ddl_if(dialect='postgresql', callable_=has_pg_trgm),
+        db.Index('ix_products_name_trgm', 'name', postgresql_using='gin',
+                 postgresql_ops={'name': 'gin_trgm_ops'}).ddl_if(dialect='postgresql', callable_=has_pg_trgm),
+        db.Index('ix_products_location_trgm', 'location', postgresql_using='gin',
+                 postgresql_ops={'location': 'gin_trgm_ops'}).ddl_if(dialect='postgresql', callable_=has_pg_trgm),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String(50), unique=True, nullable=False)
     name = db.Column(db.String(200), nullable=False)
@@ -12,7 +45,7 @@ class Product(db.Model):
     location = db.Column(db.String(100))
     min_stock = db.Column(db.Float, default=5.0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=utcnow(), onupdate=utcnow())
 
 class ConsumptionBill(db.Model):
     __tablename__ = 'consumption_bills'
@@ -25,7 +58,7 @@ class ConsumptionBill(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationship to bill items
-    items = db.relationship('BillItem', backref='bill', lazy=True, cascade='all, delete-orphan')
+    items = db.relationship('BillItem', back_populates='bill', lazy=True, cascade='all, delete-orphan', order_by='BillItem.item_number')
 
 class BillItem(db.Model):
     __tablename__ = 'bill_items'
@@ -38,6 +71,9 @@ class BillItem(db.Model):
     unit = db.Column(db.String(20), nullable=False)
     quantity = db.Column(db.Float, nullable=False)
     location = db.Column(db.String(100))
+    
+    # Relationship to parent bill
+    bill = db.relationship('ConsumptionBill', back_populates='items')
 
 class ReceptionSheet(db.Model):
     __tablename__ = 'reception_sheets'
@@ -51,7 +87,7 @@ class ReceptionSheet(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationship to reception items
-    items = db.relationship('ReceptionItem', backref='reception', lazy=True, cascade='all, delete-orphan')
+    items = db.relationship('ReceptionItem', back_populates='reception', lazy=True, cascade='all, delete-orphan', order_by='ReceptionItem.item_number')
 
 class ReceptionItem(db.Model):
     __tablename__ = 'reception_items'
@@ -65,6 +101,9 @@ class ReceptionItem(db.Model):
     quantity = db.Column(db.Float, nullable=False)
     location = db.Column(db.String(100))
     entry_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    # Relationship to parent reception
+    reception = db.relationship('ReceptionSheet', back_populates='items')
 
 class DraftBill(db.Model):
     __tablename__ = 'draft_bills'
@@ -75,19 +114,22 @@ class DraftBill(db.Model):
     last_updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationship to draft items
-    items = db.relationship('DraftBillItem', backref='draft', lazy=True, cascade='all, delete-orphan')
+    items = db.relationship('DraftBillItem', back_populates='draft', lazy=True, cascade='all, delete-orphan', passive_deletes=True, order_by='DraftBillItem.item_number')
 
 class DraftBillItem(db.Model):
     __tablename__ = 'draft_bill_items'
     
     id = db.Column(db.Integer, primary_key=True)
-    draft_id = db.Column(db.Integer, db.ForeignKey('draft_bills.id'), nullable=False)
+    draft_id = db.Column(db.Integer, db.ForeignKey('draft_bills.id', ondelete='CASCADE'), nullable=False)
     item_number = db.Column(db.Integer, nullable=False)
     product_code = db.Column(db.String(50), nullable=False)
     product_name = db.Column(db.String(200), nullable=False)
     unit = db.Column(db.String(20), nullable=False)
     quantity = db.Column(db.Float, nullable=False)
     location = db.Column(db.String(100))
+    
+    # Relationship to parent draft
+    draft = db.relationship('DraftBill', back_populates='items')
 
 class DraftReception(db.Model):
     __tablename__ = 'draft_receptions'
@@ -99,16 +141,19 @@ class DraftReception(db.Model):
     last_updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationship to draft items
-    items = db.relationship('DraftReceptionItem', backref='draft', lazy=True, cascade='all, delete-orphan')
+    items = db.relationship('DraftReceptionItem', back_populates='draft', lazy=True, cascade='all, delete-orphan', passive_deletes=True, order_by='DraftReceptionItem.item_number')
 
 class DraftReceptionItem(db.Model):
     __tablename__ = 'draft_reception_items'
     
     id = db.Column(db.Integer, primary_key=True)
-    draft_id = db.Column(db.Integer, db.ForeignKey('draft_receptions.id'), nullable=False)
+    draft_id = db.Column(db.Integer, db.ForeignKey('draft_receptions.id', ondelete='CASCADE'), nullable=False)
     item_number = db.Column(db.Integer, nullable=False)
     product_code = db.Column(db.String(50), nullable=False)
     product_name = db.Column(db.String(200), nullable=False)
     unit = db.Column(db.String(20), nullable=False)
     quantity = db.Column(db.Float, nullable=False)
-    location = db.Column(db.String(100))
\ No newline at end of file
+    location = db.Column(db.String(100))
+    
+    # Relationship to parent draft
+    draft = db.relationship('DraftReception', back_populates='items')
\ No newline at end of file